@@ -9,13 +9,19 @@ Built with DeepAgents - the agent autonomously decides which tools to use.
 """
 
 from dotenv import load_dotenv
+from collections import deque
+from functools import lru_cache
+from pathlib import Path
+import json
+import math
+import os
+import re
 import sqlite3
+import threading
 import requests
-from langchain_community.utilities.sql_database import SQLDatabase
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage, ToolMessage
 from langchain_core.tools import tool
-from langchain_openai import ChatOpenAI
-from sqlalchemy import create_engine
-from sqlalchemy.pool import StaticPool
+from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from deepagents import create_deep_agent
 
 # Load environment variables
@@ -23,80 +29,274 @@ load_dotenv()
 
 
 # Database setup
-def get_engine_for_chinook_db():
-    """Pull sql file, populate in-memory database, and create engine."""
-    url = "https://raw.githubusercontent.com/lerocha/chinook-database/master/ChinookDatabase/DataSources/Chinook_Sqlite.sql"
-    response = requests.get(url)
-    sql_script = response.text
-
+CHINOOK_URL = "https://raw.githubusercontent.com/lerocha/chinook-database/master/ChinookDatabase/DataSources/Chinook_Sqlite.sql"
+CACHE_DIR = Path("~/.cache/sql-support-bot").expanduser()
+CHINOOK_SQL_PATH = CACHE_DIR / "chinook.sql"
+CHINOOK_ETAG_PATH = CACHE_DIR / "chinook.etag"
+CHINOOK_IMAGE_PATH = CACHE_DIR / "chinook.sqlite3.bin"
+RESPONSE_CACHE_PATH = CACHE_DIR / "responses.jsonl"
+
+
+def _refresh_chinook_sql():
+    """Download the Chinook SQL script if the cached copy is missing or stale.
+
+    The cached copy is revalidated with its ETag, so an unchanged script costs a
+    304 response and no transfer. If the server can't be reached, the cached
+    script or snapshot is used as-is. Returns whether a new script was downloaded, and its
+    ETag (None if the server sent none). The ETag is not stored here; see
+    `_save_etag`.
+    """
+    headers = {}
+    if CHINOOK_SQL_PATH.exists() and CHINOOK_ETAG_PATH.exists():
+        headers["If-None-Match"] = CHINOOK_ETAG_PATH.read_text().strip()
+    try:
+        with requests.get(CHINOOK_URL, headers=headers, stream=True, timeout=30) as response:
+            if response.status_code == 304:
+                return False, None
+            response.raise_for_status()
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_path = CHINOOK_SQL_PATH.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+            os.replace(tmp_path, CHINOOK_SQL_PATH)
+            return True, response.headers.get("ETag")
+    except requests.RequestException:
+        # Offline: either cached copy is enough to start
+        if CHINOOK_SQL_PATH.exists() or CHINOOK_IMAGE_PATH.exists():
+            return False, None
+        raise
+
+
+def _save_etag(etag):
+    """Record the ETag of the script the current snapshot was built from."""
+    if etag:
+        CHINOOK_ETAG_PATH.write_text(etag)
+    else:
+        CHINOOK_ETAG_PATH.unlink(missing_ok=True)
+
+
+def _save_snapshot(connection):
+    """Write the hydrated database's page image to disk so later starts can skip the SQL script."""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp_path = CHINOOK_IMAGE_PATH.with_suffix(".tmp")
+    tmp_path.write_bytes(connection.serialize())
+    os.replace(tmp_path, CHINOOK_IMAGE_PATH)
+
+
+def _apply_pragmas(connection):
+    """Keep temporary tables and sort spills in memory too."""
+    # Disk-oriented settings (journal_mode, mmap_size, synchronous, a larger
+    # cache_size) do nothing for a database that already lives in memory.
+    connection.execute("PRAGMA temp_store=MEMORY")
+
+
+def _build_search_indexes(connection):
+    """Create trigram FTS5 indexes for the tools' substring searches.
+
+    A trigram index answers `LIKE '%x%'` without scanning the base table. Like
+    plain LIKE, matching is case-insensitive for ASCII only; non-ASCII letters
+    must match case exactly. Returns True if the indexes were built.
+    """
+    if connection.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'track_fts'"
+    ).fetchone():
+        return False
+    connection.executescript("""
+        CREATE VIRTUAL TABLE artist_fts USING fts5(
+            Name, content='Artist', content_rowid='ArtistId', tokenize='trigram'
+        );
+        INSERT INTO artist_fts(rowid, Name) SELECT ArtistId, Name FROM Artist;
+
+        CREATE VIRTUAL TABLE track_fts USING fts5(
+            Name, content='Track', content_rowid='TrackId', tokenize='trigram'
+        );
+        INSERT INTO track_fts(rowid, Name) SELECT TrackId, Name FROM Track;
+    """)
+    return True
+
+
+def get_connection_for_chinook_db():
+    """Populate in-memory database from the cached snapshot or sql file, and return its connection."""
     connection = sqlite3.connect(":memory:", check_same_thread=False)
-    connection.executescript(sql_script)
-    return create_engine(
-        "sqlite://",
-        creator=lambda: connection,
-        poolclass=StaticPool,
-        connect_args={"check_same_thread": False},
+    # A new script invalidates the snapshot built from the old one.
+    downloaded, etag = _refresh_chinook_sql()
+    hydrated = downloaded or not CHINOOK_IMAGE_PATH.exists()
+    if hydrated:
+        connection.executescript(CHINOOK_SQL_PATH.read_text(encoding="utf-8"))
+    else:
+        # Load the saved page image directly; no SQL parsing at all.
+        connection.deserialize(CHINOOK_IMAGE_PATH.read_bytes())
+    _apply_pragmas(connection)
+    if _build_search_indexes(connection) or hydrated:
+        _save_snapshot(connection)
+    if downloaded:
+        # Only once the new snapshot is on disk; until then the old ETag makes
+        # the next start download the script again and rebuild.
+        _save_etag(etag)
+    # The catalog is never modified at runtime; reject any accidental writes.
+    connection.execute("PRAGMA query_only=ON")
+    return connection
+
+
+connection = get_connection_for_chinook_db()
+
+# The tools query the database directly through one shared sqlite3 cursor rather
+# than through SQLAlchemy and langchain's SQLDatabase, which check a connection
+# out of a pool and re-format every result. When the model requests several
+# tools in one turn, LangGraph's ToolNode runs them concurrently on a thread
+# pool, and sqlite3 connections are not thread-safe, hence the lock. Queries
+# take well under a millisecond, so serializing them costs nothing noticeable.
+_cursor = connection.cursor()
+_cursor_lock = threading.Lock()
+
+
+# Upper bound on rows returned by the music tools; every row becomes input
+# tokens on the model's next turn.
+MAX_TOOL_ROWS = 50
+
+
+def _query(sql: str, params: dict) -> list[dict]:
+    """Execute a read-only query and return the rows as column/value dicts."""
+    with _cursor_lock:
+        rows = _cursor.execute(sql, params).fetchall()
+        columns = [d[0] for d in _cursor.description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def _to_json(rows: list[dict]) -> str:
+    """Format rows the way every tool returns them."""
+    return json.dumps(rows, default=str)
+
+
+def _run(sql: str, params: dict, limit: int | None = None) -> str:
+    """Execute a read-only query and return the rows as a JSON list of objects.
+
+    With `limit`, the query must take a `:limit` parameter. At most `limit` rows
+    are returned, followed by a note when more rows matched.
+    """
+    if limit is not None:
+        # Fetch one extra row to tell whether the result was cut off
+        params = {**params, "limit": limit + 1}
+    rows = _query(sql, params)
+    result = _to_json(rows[:limit])
+    if limit is not None and len(rows) > limit:
+        result += (
+            f"\n... (truncated to the first {limit} matches, more available; "
+            "search with a more specific name to narrow them down)"
+        )
+    return result
+
+
+# Tool queries use bound parameters so SQLite's statement cache hits and tool
+# arguments can never be spliced into the SQL text.
+ALBUMS_BY_ARTIST = """
+    SELECT Album.Title, Artist.Name
+    FROM Album
+    JOIN Artist ON Album.ArtistId = Artist.ArtistId
+    WHERE Artist.ArtistId IN (
+        SELECT rowid FROM artist_fts WHERE artist_fts.Name LIKE :artist
     )
+    LIMIT :limit;
+"""
+
+TRACKS_BY_ARTIST = """
+    SELECT Track.Name as SongName, Artist.Name as ArtistName
+    FROM Album
+    LEFT JOIN Artist ON Album.ArtistId = Artist.ArtistId
+    LEFT JOIN Track ON Track.AlbumId = Album.AlbumId
+    WHERE Artist.ArtistId IN (
+        SELECT rowid FROM artist_fts WHERE artist_fts.Name LIKE :artist
+    )
+    LIMIT :limit;
+"""
+
+SONGS_BY_TITLE = """
+    SELECT Track.Name, Track.AlbumId
+    FROM track_fts
+    JOIN Track ON Track.TrackId = track_fts.rowid
+    WHERE track_fts.Name LIKE :title
+    LIMIT :limit;
+"""
+
+
+# Tool query helpers. The Chinook database is loaded once and never written
+# to, so results are cached by argument for the life of the process. Arguments
+# are only stripped, never case-folded: SQLite's LIKE folds ASCII case only, so
+# lowercasing "Ólafur" would stop it matching.
+@lru_cache(maxsize=1024)
+def _albums_by_artist(artist_key: str):
+    return _run(ALBUMS_BY_ARTIST, {"artist": f"%{artist_key}%"}, limit=MAX_TOOL_ROWS)
+
+
+@lru_cache(maxsize=1024)
+def _tracks_by_artist(artist_key: str):
+    return _run(TRACKS_BY_ARTIST, {"artist": f"%{artist_key}%"}, limit=MAX_TOOL_ROWS)
+
 
+@lru_cache(maxsize=1024)
+def _songs_by_title(title_key: str):
+    return _run(SONGS_BY_TITLE, {"title": f"%{title_key}%"}, limit=MAX_TOOL_ROWS)
 
-engine = get_engine_for_chinook_db()
-db = SQLDatabase(engine)
+
+def _load_customers():
+    """Serialize every customer record once, keyed by CustomerId."""
+    rows = _query("SELECT * FROM Customer", {})
+    return {row["CustomerId"]: _to_json([row]) for row in rows}
+
+
+# Chinook has only a few dozen customers, so the whole table is held in memory
+# and a customer lookup is a single dict lookup instead of a query.
+_customers_by_id = _load_customers()
 
 
 # Music-related tools
 @tool
 def get_albums_by_artist(artist: str):
     """Get albums by an artist."""
-    return db.run(
-        f"""
-        SELECT Album.Title, Artist.Name
-        FROM Album
-        JOIN Artist ON Album.ArtistId = Artist.ArtistId
-        WHERE Artist.Name LIKE '%{artist}%';
-        """,
-        include_columns=True
-    )
+    return _albums_by_artist(artist.strip())
 
 
 @tool
 def get_tracks_by_artist(artist: str):
     """Get songs by an artist (or similar artists)."""
-    return db.run(
-        f"""
-        SELECT Track.Name as SongName, Artist.Name as ArtistName
-        FROM Album
-        LEFT JOIN Artist ON Album.ArtistId = Artist.ArtistId
-        LEFT JOIN Track ON Track.AlbumId = Album.AlbumId
-        WHERE Artist.Name LIKE '%{artist}%';
-        """,
-        include_columns=True
-    )
+    return _tracks_by_artist(artist.strip())
 
 
 @tool
 def check_for_songs(song_title: str):
     """Check if a song exists by its name."""
-    return db.run(
-        f"""
-        SELECT * FROM Track WHERE Name LIKE '%{song_title}%';
-        """,
-        include_columns=True
-    )
+    return _songs_by_title(song_title.strip())
 
 
 # Customer-related tools
 @tool
 def get_customer_info(customer_id: int):
     """Look up customer info given their ID. ALWAYS make sure you have the customer ID before invoking this."""
-    return db.run(f"SELECT * FROM Customer WHERE CustomerID = {customer_id};")
+    return _customers_by_id.get(customer_id, "[]")
 
 
-def create_agent():
-    """
-    Create a DeepAgent with all tools.
-    The agent autonomously decides which tools to use based on the user's query.
-    """
-    system_prompt = """You are a helpful customer service representative for a music store.
+# All tools the agent can call. @tool builds each tool's argument schema once,
+# at import time, so agents built from this list share it.
+TOOLS = [
+    get_albums_by_artist,
+    get_tracks_by_artist,
+    check_for_songs,
+    get_customer_info,
+]
+
+
+# Static notes on tool output, appended to the system prompt. Keep this free of
+# conversation-specific text so the prompt prefix stays identical across
+# requests and OpenAI's automatic prompt caching can reuse it.
+TOOL_USAGE_GUIDE = f"""
+
+Tool results are JSON lists with one object per matching row; an empty list
+(`[]`) means nothing matched, so say so and suggest a different spelling or a
+shorter search term. The music tools return at most {MAX_TOOL_ROWS} rows and add a note
+when more matched; summarize long results instead of repeating every row."""
+
+SYSTEM_PROMPT = """You are a helpful customer service representative for a music store.
 
 You can help customers in two main ways:
 
@@ -110,33 +310,199 @@ You can help customers in two main ways:
    - Use get_customer_info to look up customer details (requires customer ID)
    - Always ask for the customer ID before invoking the tool
 
-Be polite, helpful, and guide customers to provide any information you need (like customer ID) before calling tools."""
+Be polite, helpful, and guide customers to provide any information you need (like customer ID) before calling tools.""" + TOOL_USAGE_GUIDE
 
+# Shared chat model. ChatOpenAI holds an HTTP client, so reusing one instance
+# keeps connections to the API warm across agent runs.
+llm = ChatOpenAI(
+    model="gpt-4o",
+    temperature=0,
+    streaming=True,
+    # Routes requests sharing the static prefix to the same prompt cache.
+    model_kwargs={"prompt_cache_key": "sql-support-bot-v1"},
+)
+
+# Smaller model for mechanical side tasks (cache verification, history
+# summaries). The conversation itself stays on gpt-4o.
+helper_llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+
+
+@lru_cache(maxsize=1)
+def create_agent():
+    """
+    Create a DeepAgent with all tools.
+    The agent autonomously decides which tools to use based on the user's query.
+    The compiled graph is stateless, so it is built once and reused.
+    """
     agent = create_deep_agent(
-        model=ChatOpenAI(model="gpt-4o", temperature=0),
-        tools=[
-            get_albums_by_artist,
-            get_tracks_by_artist,
-            check_for_songs,
-            get_customer_info
-        ],
-        system_prompt=system_prompt
+        model=llm,
+        tools=TOOLS,
+        system_prompt=SYSTEM_PROMPT
     )
 
     return agent
 
 
+class SemanticCache:
+    """Reuse the answer to an earlier question that asks the same thing.
+
+    Questions are embedded and compared with the ones already answered. Above
+    `hit_threshold` the earlier answer is returned as-is, below
+    `miss_threshold` the cache is skipped, and in between a small model checks
+    whether the two questions really ask for the same information.
+
+    Only answers that don't depend on the conversation or the customer belong
+    here (see `is_self_contained_catalog_turn`). Entries additionally only
+    match questions containing the same numbers. With `path`, entries are
+    persisted as JSON lines so they carry over between runs.
+    """
+
+    def __init__(self, embeddings, verifier, path=None, hit_threshold=0.93, miss_threshold=0.70, max_entries=512):
+        self.verifier = verifier
+        self.path = path
+        self.hit_threshold = hit_threshold
+        self.miss_threshold = miss_threshold
+        self._entries = deque(maxlen=max_entries)
+        # `add` re-embeds the question `lookup` just embedded; avoid paying twice.
+        self._embed = lru_cache(maxsize=32)(embeddings.embed_query)
+        if path is not None and path.exists():
+            self._load()
+
+    def _load(self):
+        with open(self.path, encoding="utf-8") as f:
+            lines = f.readlines()
+        for line in lines:
+            entry = json.loads(line)
+            entry["scope"] = tuple(entry["scope"])
+            self._entries.append(entry)
+        if len(lines) > len(self._entries):
+            # Drop entries that fell out of the deque so the file stays bounded
+            self.path.write_text(
+                "".join(json.dumps(e) + "\n" for e in self._entries), encoding="utf-8"
+            )
+
+    @staticmethod
+    def _scope(question):
+        return tuple(re.findall(r"\d+", question))
+
+    @staticmethod
+    def _similarity(a, b):
+        return sum(x * y for x, y in zip(a, b)) / (math.hypot(*a) * math.hypot(*b))
+
+    def _same_question(self, question, cached_question):
+        reply = self.verifier.invoke(
+            "Do these two customer messages ask for exactly the same information? "
+            "Answer only 'yes' or 'no'.\n\n"
+            f"Message 1: {cached_question}\nMessage 2: {question}"
+        )
+        return reply.content.strip().lower().startswith("yes")
+
+    def lookup(self, question):
+        """Return a cached answer for the question, or None."""
+        scope = self._scope(question)
+        candidates = [entry for entry in self._entries if entry["scope"] == scope]
+        if not candidates:
+            # Nothing could match; don't pay for an embedding
+            return None
+        vector = self._embed(question)
+        best = max(candidates, key=lambda entry: self._similarity(vector, entry["vector"]))
+        best_score = self._similarity(vector, best["vector"])
+        if best_score < self.miss_threshold:
+            return None
+        if best_score >= self.hit_threshold or self._same_question(question, best["question"]):
+            return best["answer"]
+        return None
+
+    def add(self, question, answer):
+        """Remember the answer given to a question."""
+        entry = {
+            "scope": self._scope(question),
+            "question": question,
+            "vector": self._embed(question),
+            "answer": answer,
+        }
+        self._entries.append(entry)
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+
+
+CATALOG_TOOL_NAMES = {
+    get_albums_by_artist.name,
+    get_tracks_by_artist.name,
+    check_for_songs.name,
+}
+
+
+def is_self_contained_catalog_turn(question, tool_calls):
+    """Whether an answer came only from catalog lookups spelled out in the question.
+
+    Such an answer depends neither on earlier turns nor on who is asking, so it
+    can be shared with anyone asking the same thing. Turns that used no tools,
+    customer data or any other tool, or that searched for something the
+    question doesn't mention (a follow-up like "what about their albums?"),
+    are not.
+    """
+    if not tool_calls:
+        return False
+    folded = question.casefold()
+    return all(
+        call["name"] in CATALOG_TOOL_NAMES
+        and all(str(value).strip().casefold() in folded for value in call["args"].values())
+        for call in tool_calls
+    )
+
+
+# Conversation history limits. Once the transcript grows past
+# MAX_HISTORY_MESSAGES, everything but the last KEPT_HISTORY_MESSAGES is folded
+# into a running summary, so each request re-sends a bounded number of tokens.
+MAX_HISTORY_MESSAGES = 12
+KEPT_HISTORY_MESSAGES = 6
+
+
+def compact_history(history, summary, summarizer):
+    """Fold older turns into the running summary once history gets too long.
+
+    Returns the (possibly shortened) history and the updated summary.
+    """
+    if len(history) <= MAX_HISTORY_MESSAGES:
+        return history, summary
+    evicted, kept = history[:-KEPT_HISTORY_MESSAGES], history[-KEPT_HISTORY_MESSAGES:]
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in evicted)
+    reply = summarizer.invoke(
+        "Summarize this customer support conversation in a few sentences. Keep "
+        "any customer IDs, names, artists, albums and songs that were mentioned "
+        "and any open requests.\n\n"
+        f"Earlier summary: {summary or '(none)'}\n\nConversation:\n{transcript}"
+    )
+    return kept, reply.content
+
+
+def with_summary(history, summary):
+    """Prefix the history with the running summary, if there is one."""
+    if not summary:
+        return history
+    return [{"role": "system", "content": f"Summary of the earlier conversation: {summary}"}] + history
+
+
 # Main entry point
 if __name__ == "__main__":
     print("=== SQL Support Bot with DeepAgents ===\n")
     print("Initializing agent...\n")
 
     agent = create_agent()
+    response_cache = SemanticCache(
+        embeddings=OpenAIEmbeddings(model="text-embedding-3-small"),
+        verifier=helper_llm,
+        path=RESPONSE_CACHE_PATH,
+    )
 
     print("Agent ready! Type 'quit' to exit.\n")
 
     # Interactive loop
     conversation_history = []
+    history_summary = ""
 
     while True:
         user_input = input("You: ")
@@ -145,16 +511,48 @@ if __name__ == "__main__":
             break
 
         conversation_history.append({"role": "user", "content": user_input})
+        messages = with_summary(conversation_history, history_summary)
 
-        # Invoke the agent
-        result = agent.invoke({"messages": conversation_history})
-
-        # Extract the latest AI response
-        if result and "messages" in result:
-            ai_message = result["messages"][-1]
-            ai_content = ai_message.content if hasattr(ai_message, 'content') else str(ai_message)
-
+        ai_content = response_cache.lookup(user_input)
+        if ai_content is not None:
             print(f"\nAssistant: {ai_content}\n")
-
-            # Add to conversation history
-            conversation_history.append({"role": "assistant", "content": ai_content})
+        else:
+            # Stream the agent's reply, printing tokens as they arrive
+            print("\nAssistant: ", end="", flush=True)
+            ai_content = ""
+            final_state = None
+            for mode, payload in agent.stream(
+                {"messages": messages}, stream_mode=["messages", "values"]
+            ):
+                if mode == "values":
+                    final_state = payload
+                    continue
+                message, _metadata = payload
+                if isinstance(message, ToolMessage):
+                    # Text before a tool call is not part of the final answer
+                    if ai_content:
+                        print("\n", flush=True)
+                    ai_content = ""
+                elif isinstance(message, AIMessageChunk) and isinstance(message.content, str):
+                    print(message.content, end="", flush=True)
+                    ai_content += message.content
+            print("\n")
+            if not ai_content:
+                # No reply to record; drop the question so turns keep alternating
+                conversation_history.pop()
+                continue
+            # Tool calls the agent made for this question, i.e. after the last user message
+            tool_calls = []
+            for m in reversed(final_state["messages"] if final_state else []):
+                if isinstance(m, HumanMessage):
+                    break
+                if isinstance(m, AIMessage):
+                    tool_calls.extend(m.tool_calls)
+            if is_self_contained_catalog_turn(user_input, tool_calls):
+                response_cache.add(user_input, ai_content)
+
+        # Add to conversation history
+        conversation_history.append({"role": "assistant", "content": ai_content})
+        conversation_history, history_summary = compact_history(
+            conversation_history, history_summary, helper_llm
+        )